@@ -1,12 +1,17 @@
 """Feishu/Lark channel implementation using lark-oapi SDK with WebSocket long connection."""
 
 import asyncio
+import hashlib
 import json
+import os
 import re
+import shutil
 import threading
-from collections import OrderedDict
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 from loguru import logger
 
@@ -33,6 +38,11 @@ except ImportError:
     Emoji = None
     GetMessageResourceRequest = None
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Message type display mapping
 MSG_TYPE_MAP = {
     "image": "[image]",
@@ -41,6 +51,48 @@ MSG_TYPE_MAP = {
     "sticker": "[sticker]",
 }
 
+# File extension by MIME type for downloaded media
+MIME_EXTENSIONS = {
+    "image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif",
+    "image/webp": ".webp", "image/bmp": ".bmp",
+    "audio/mpeg": ".mp3", "audio/mp4": ".m4a", "audio/ogg": ".ogg",
+    "audio/wav": ".wav", "audio/x-wav": ".wav",
+    "video/mp4": ".mp4", "video/webm": ".webm",
+    "application/pdf": ".pdf",
+    "application/msword": ".doc",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+    "application/vnd.ms-excel": ".xls",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+    "application/vnd.ms-powerpoint": ".ppt",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+    "text/plain": ".txt",
+    "application/zip": ".zip",
+    "application/x-rar-compressed": ".rar",
+}
+
+# Fallback file extension by Feishu message type
+MSG_TYPE_EXTENSIONS = {
+    "image": ".jpg",
+    "file": "",
+    "audio": ".mp3",
+    "video": ".mp4",
+    "media": "",
+}
+
+
+def _json_dumps(obj: Any) -> str:
+    """Serialize to compact JSON, using orjson when installed."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _json_loads(data: str | bytes) -> Any:
+    """Parse JSON, using orjson when installed (raises json.JSONDecodeError either way)."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 class FeishuChannel(BaseChannel):
     """
@@ -62,9 +114,16 @@ class FeishuChannel(BaseChannel):
         self._client: Any = None
         self._ws_client: Any = None
         self._ws_thread: threading.Thread | None = None
-        self._processed_message_ids: OrderedDict[str, None] = OrderedDict()  # Ordered dedup cache
+        self._processed_message_ids: set[str] = set()  # Dedup cache (membership)
+        self._processed_message_order: deque[str] = deque(maxlen=1000)  # Dedup cache (eviction order)
         self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop_event = asyncio.Event()
         self._workspace = workspace or Path.cwd()  # Use provided workspace or current directory
+        # Downloaded media lives in the workspace (so AI can access it even with restrict_to_workspace)
+        self._media_dir = self._workspace / "media"
+        self._pending_downloads: dict[str, asyncio.Future] = {}  # In-flight downloads by file_key
+        # Dedicated pool for blocking SDK calls; also caps concurrent Feishu API requests
+        self._io_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="feishu-io")
     
     async def start(self) -> None:
         """Start the Feishu bot with WebSocket long connection."""
@@ -79,6 +138,9 @@ class FeishuChannel(BaseChannel):
         self._running = True
         self._loop = asyncio.get_running_loop()
         
+        # Create media directory once here rather than on every download
+        self._media_dir.mkdir(parents=True, exist_ok=True)
+        
         # Create Lark client for sending messages
         self._client = lark.Client.builder() \
             .app_id(self.config.app_id) \
@@ -115,20 +177,26 @@ class FeishuChannel(BaseChannel):
         logger.info("Feishu bot started with WebSocket long connection")
         logger.info("No public IP required - using WebSocket to receive events")
         
-        # Keep running until stopped
-        while self._running:
-            await asyncio.sleep(1)
+        # Keep running until stopped (no periodic wakeups while idle)
+        await self._stop_event.wait()
     
     async def stop(self) -> None:
         """Stop the Feishu bot."""
         self._running = False
+        self._stop_event.set()
         if self._ws_client:
             try:
                 self._ws_client.stop()
             except Exception as e:
                 logger.warning(f"Error stopping WebSocket client: {e}")
+        self._io_executor.shutdown(wait=False)
         logger.info("Feishu bot stopped")
     
+    async def _run_io(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run a blocking SDK call on the channel's I/O thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, func, *args)
+    
     def _add_reaction_sync(self, message_id: str, emoji_type: str) -> None:
         """Sync helper for adding reaction (runs in thread pool)."""
         try:
@@ -158,40 +226,54 @@ class FeishuChannel(BaseChannel):
         if not self._client or not Emoji:
             return
         
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, self._add_reaction_sync, message_id, emoji_type)
+        await self._run_io(self._add_reaction_sync, message_id, emoji_type)
     
-    def _get_extension(self, msg_type: str, mime_type: str | None = None) -> str:
+    @staticmethod
+    def _get_extension(msg_type: str, mime_type: str | None = None) -> str:
         """Get file extension based on message type and MIME type."""
         if mime_type:
-            ext_map = {
-                "image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif",
-                "image/webp": ".webp", "image/bmp": ".bmp",
-                "audio/mpeg": ".mp3", "audio/mp4": ".m4a", "audio/ogg": ".ogg",
-                "audio/wav": ".wav", "audio/x-wav": ".wav",
-                "video/mp4": ".mp4", "video/webm": ".webm",
-                "application/pdf": ".pdf",
-                "application/msword": ".doc",
-                "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
-                "application/vnd.ms-excel": ".xls",
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
-                "application/vnd.ms-powerpoint": ".ppt",
-                "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
-                "text/plain": ".txt",
-                "application/zip": ".zip",
-                "application/x-rar-compressed": ".rar",
-            }
-            if mime_type in ext_map:
-                return ext_map[mime_type]
+            # Keys are lowercase; only lowercase the MIME type on a miss
+            ext = MIME_EXTENSIONS.get(mime_type) or MIME_EXTENSIONS.get(mime_type.lower())
+            if ext:
+                return ext
+        return MSG_TYPE_EXTENSIONS.get(msg_type, "")
+    
+    @staticmethod
+    def _write_file_sync(file_path: Path, file_content: Any) -> None:
+        """
+        Sync helper for writing downloaded content to disk (runs in thread pool).
         
-        type_map = {
-            "image": ".jpg",
-            "file": "",
-            "audio": ".mp3",
-            "video": ".mp4",
-            "media": "",
-        }
-        return type_map.get(msg_type, "")
+        Writes to a temp file in the same directory and renames it onto file_path
+        only once complete, so file_path never holds a partial download.
+        """
+        tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex}.part")
+        try:
+            f = open(tmp_path, 'xb')
+        except FileNotFoundError:
+            # Media directory is created in start(); recreate it if it was removed since
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(tmp_path, 'xb')
+        try:
+            with f:
+                FeishuChannel._write_content(f, file_content)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    
+    @staticmethod
+    def _write_content(f: Any, file_content: Any) -> None:
+        """Write downloaded content (BytesIO, file object or bytes) to an open file."""
+        if hasattr(file_content, 'getvalue'):
+            # BytesIO: getvalue() returns the bytes it was built from without copying
+            # (getbuffer() would unshare, i.e. copy, the whole payload)
+            f.write(file_content.getvalue())
+        elif hasattr(file_content, 'read'):
+            # Fallback for non-BytesIO file objects (the SDK always returns a BytesIO
+            # already held in memory, so this is not a memory bound for Feishu downloads)
+            shutil.copyfileobj(file_content, f, 1024 * 1024)
+        else:
+            f.write(file_content)
     
     async def _download_file(self, file_key: str, msg_type: str, message_id: str) -> str | None:
         """
@@ -209,6 +291,32 @@ class FeishuChannel(BaseChannel):
             logger.warning("Feishu client or GetMessageResourceRequest not available")
             return None
         
+        # Name the file after a hash of the full file_key: the same key always maps to
+        # the same file, and keys sharing a long common prefix cannot collide
+        file_stem = hashlib.blake2b(file_key.encode(), digest_size=8).hexdigest()
+        
+        # A file_key identifies immutable content, so an earlier download can be reused
+        # (files only appear under their final name once fully written)
+        existing = self._media_dir / f"{file_stem}{self._get_extension(msg_type)}"
+        if existing.is_file():
+            logger.debug(f"Reusing downloaded {msg_type} file {existing}")
+            return str(existing)
+        
+        # Concurrent messages with the same file_key share one in-flight download
+        pending = self._pending_downloads.get(file_key)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self._fetch_file(file_key, file_stem, msg_type, message_id)
+            )
+            self._pending_downloads[file_key] = pending
+            pending.add_done_callback(lambda _: self._pending_downloads.pop(file_key, None))
+        # Shield so one cancelled caller doesn't cancel the download for the others
+        return await asyncio.shield(pending)
+    
+    async def _fetch_file(
+        self, file_key: str, file_stem: str, msg_type: str, message_id: str
+    ) -> str | None:
+        """Fetch a message resource from Feishu and save it as media_dir/<file_stem><ext>."""
         try:
             # Build request to get file resource
             request = GetMessageResourceRequest.builder() \
@@ -218,8 +326,7 @@ class FeishuChannel(BaseChannel):
                 .build()
             
             # Execute request in thread pool (blocking I/O)
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, self._client.im.v1.message_resource.get, request)
+            response = await self._run_io(self._client.im.v1.message_resource.get, request)
             
             if not response.success():
                 logger.warning(
@@ -234,26 +341,15 @@ class FeishuChannel(BaseChannel):
                 logger.warning("File content is empty")
                 return None
             
-            # Read bytes from BytesIO object
-            if hasattr(file_content, 'read'):
-                file_bytes = file_content.read()
-            else:
-                file_bytes = file_content
-            
             # Determine file extension
             mime_type = getattr(response, 'mime_type', None)
             ext = self._get_extension(msg_type, mime_type)
             
-            # Create media directory in workspace (so AI can access it even with restrict_to_workspace)
-            media_dir = self._workspace / "media"
-            media_dir.mkdir(parents=True, exist_ok=True)
-            
             # Generate file path
-            file_path = media_dir / f"{file_key[:16]}{ext}"
+            file_path = self._media_dir / f"{file_stem}{ext}"
             
-            # Write file content
-            with open(file_path, 'wb') as f:
-                f.write(file_bytes)
+            # Write file content in thread pool (blocking disk I/O)
+            await self._run_io(self._write_file_sync, file_path, file_content)
             
             logger.info(f"Downloaded {msg_type} file to {file_path}")
             return str(file_path)
@@ -262,39 +358,55 @@ class FeishuChannel(BaseChannel):
             logger.error(f"Error downloading file from Feishu: {e}")
             return None
     
-    # Regex to match markdown tables (header + separator + data rows)
+    # Regex to match markdown tables (header + separator + data rows).
+    # Cells use [^\n] and the separator stays on one line; the possessive
+    # row repetition (Python 3.11+) never backtracks into rows it has matched.
     _TABLE_RE = re.compile(
-        r"((?:^[ \t]*\|.+\|[ \t]*\n)(?:^[ \t]*\|[-:\s|]+\|[ \t]*\n)(?:^[ \t]*\|.+\|[ \t]*\n?)+)",
+        r"((?:^[ \t]*\|[^\n]+\|[ \t]*\n)(?:^[ \t]*\|[-:| \t]+\|[ \t]*\n)(?:^[ \t]*\|[^\n]+\|[ \t]*\n?)++)",
         re.MULTILINE,
     )
 
+    @staticmethod
+    def _split_md_row(line: str) -> list[str]:
+        """Split a markdown table row into stripped cell values."""
+        return [c.strip() for c in line.strip("|").split("|")]
+
     @staticmethod
     def _parse_md_table(table_text: str) -> dict | None:
         """Parse a markdown table into a Feishu table element."""
-        lines = [l.strip() for l in table_text.strip().split("\n") if l.strip()]
+        lines = [l for l in (s.strip() for s in table_text.split("\n")) if l]
         if len(lines) < 3:
             return None
-        split = lambda l: [c.strip() for c in l.strip("|").split("|")]
+        split = FeishuChannel._split_md_row
         headers = split(lines[0])
-        rows = [split(l) for l in lines[2:]]
-        columns = [{"tag": "column", "name": f"c{i}", "display_name": h, "width": "auto"}
-                   for i, h in enumerate(headers)]
+        keys = [f"c{i}" for i in range(len(headers))]
+        columns = [{"tag": "column", "name": k, "display_name": h, "width": "auto"}
+                   for k, h in zip(keys, headers)]
+        rows = []
+        for line in lines[2:]:
+            cells = split(line)
+            if len(cells) < len(keys):
+                cells.extend([""] * (len(keys) - len(cells)))
+            rows.append(dict(zip(keys, cells)))  # zip drops cells beyond the header
         return {
             "tag": "table",
             "page_size": len(rows) + 1,
             "columns": columns,
-            "rows": [{f"c{i}": r[i] if i < len(r) else "" for i in range(len(headers))} for r in rows],
+            "rows": rows,
         }
 
     def _build_card_elements(self, content: str) -> list[dict]:
         """Split content into markdown + table elements for Feishu card."""
         elements, last_end = [], 0
         for m in self._TABLE_RE.finditer(content):
-            before = content[last_end:m.start()].strip()
-            if before:
-                elements.append({"tag": "markdown", "content": before})
-            elements.append(self._parse_md_table(m.group(1)) or {"tag": "markdown", "content": m.group(1)})
-            last_end = m.end()
+            start, end = m.span()
+            if start > last_end:
+                before = content[last_end:start].strip()
+                if before:
+                    elements.append({"tag": "markdown", "content": before})
+            table_text = m.group(1)
+            elements.append(self._parse_md_table(table_text) or {"tag": "markdown", "content": table_text})
+            last_end = end
         remaining = content[last_end:].strip()
         if remaining:
             elements.append({"tag": "markdown", "content": remaining})
@@ -320,7 +432,7 @@ class FeishuChannel(BaseChannel):
                 "config": {"wide_screen_mode": True},
                 "elements": elements,
             }
-            content = json.dumps(card, ensure_ascii=False)
+            content = _json_dumps(card)
             
             request = CreateMessageRequest.builder() \
                 .receive_id_type(receive_id_type) \
@@ -332,7 +444,7 @@ class FeishuChannel(BaseChannel):
                     .build()
                 ).build()
             
-            response = self._client.im.v1.message.create(request)
+            response = await self._run_io(self._client.im.v1.message.create, request)
             
             if not response.success():
                 logger.error(
@@ -364,11 +476,13 @@ class FeishuChannel(BaseChannel):
             message_id = message.message_id
             if message_id in self._processed_message_ids:
                 return
-            self._processed_message_ids[message_id] = None
             
-            # Trim cache: keep most recent 500 when exceeds 1000
-            while len(self._processed_message_ids) > 1000:
-                self._processed_message_ids.popitem(last=False)
+            # Keep the most recent 1000 ids: the deque evicts the oldest on append
+            order = self._processed_message_order
+            if len(order) == order.maxlen:
+                self._processed_message_ids.discard(order[0])
+            order.append(message_id)
+            self._processed_message_ids.add(message_id)
             
             # Skip bot messages
             sender_type = sender.sender_type
@@ -380,53 +494,50 @@ class FeishuChannel(BaseChannel):
             chat_type = message.chat_type  # "p2p" or "group"
             msg_type = message.message_type
             
-            # Add reaction to indicate "seen"
-            await self._add_reaction(message_id, "OK")
+            # Add reaction to indicate "seen" (runs alongside content parsing and media download)
+            reaction = asyncio.create_task(self._add_reaction(message_id, "OK"))
             
             # Parse message content and handle media files
             content_parts = []
             media_paths = []
             
+            # Parse message content once (shared by text, media and caption handling)
+            try:
+                content_data = _json_loads(message.content)
+            except json.JSONDecodeError:
+                content_data = None
+            
             if msg_type == "text":
-                try:
-                    content = json.loads(message.content).get("text", "")
-                    if content:
-                        content_parts.append(content)
-                except json.JSONDecodeError:
+                if content_data is not None:
+                    content = content_data.get("text", "")
+                else:
                     content = message.content or ""
-                    if content:
-                        content_parts.append(content)
+                if content:
+                    content_parts.append(content)
+            elif content_data is None:
+                content_parts.append(MSG_TYPE_MAP.get(msg_type) or f"[{msg_type}]")
             else:
                 # Handle media files (image, file, audio, video)
-                try:
-                    content_data = json.loads(message.content)
-                    file_key = content_data.get("file_key")
-                    
-                    if file_key:
-                        # Download the file
-                        file_path = await self._download_file(file_key, msg_type, message_id)
-                        if file_path:
-                            media_paths.append(file_path)
-                            content_parts.append(f"[{msg_type}: {file_path}]")
-                        else:
-                            content_parts.append(f"[{msg_type}: download failed]")
+                file_key = content_data.get("file_key")
+                
+                if file_key:
+                    # Download the file
+                    file_path = await self._download_file(file_key, msg_type, message_id)
+                    if file_path:
+                        media_paths.append(file_path)
+                        content_parts.append(f"[{msg_type}: {file_path}]")
                     else:
-                        # No file_key, just use placeholder
-                        content_parts.append(MSG_TYPE_MAP.get(msg_type, f"[{msg_type}]"))
-                except json.JSONDecodeError:
-                    content_parts.append(MSG_TYPE_MAP.get(msg_type, f"[{msg_type}]"))
-            
-            # Check for caption or additional text
-            if hasattr(message, 'content') and msg_type != "text":
-                try:
-                    content_data = json.loads(message.content)
-                    # Some media types might have additional text fields
-                    if "text" in content_data:
-                        content_parts.append(content_data["text"])
-                except (json.JSONDecodeError, AttributeError):
-                    pass
+                        content_parts.append(f"[{msg_type}: download failed]")
+                else:
+                    # No file_key, just use placeholder
+                    content_parts.append(MSG_TYPE_MAP.get(msg_type) or f"[{msg_type}]")
+                
+                # Some media types might have additional text fields (caption)
+                if "text" in content_data:
+                    content_parts.append(content_data["text"])
             
             content = "\n".join(content_parts) if content_parts else "[empty message]"
+            await reaction
             
             # Forward to message bus
             reply_to = chat_id if chat_type == "group" else sender_id
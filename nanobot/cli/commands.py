@@ -422,7 +422,13 @@ def gateway(
             agent.stop()
             await channels.stop_all()
     
-    asyncio.run(run())
+    # Prefer uvloop when installed (pip install nanobot-ai[fast])
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(run())
+    else:
+        uvloop.run(run())
 
 
 
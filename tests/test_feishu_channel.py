@@ -0,0 +1,287 @@
+import asyncio
+import time
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from nanobot.bus.queue import MessageBus
+from nanobot.channels import feishu
+from nanobot.channels.feishu import FeishuChannel
+from nanobot.config.schema import FeishuConfig
+
+
+def _make_channel(workspace: Path | None = None) -> FeishuChannel:
+    config = FeishuConfig(enabled=True, app_id="cli_test", app_secret="secret")
+    return FeishuChannel(config, MessageBus(), workspace=workspace)
+
+
+def test_build_card_elements_splits_markdown_and_tables() -> None:
+    channel = _make_channel()
+    content = (
+        "Results:\n"
+        "| name | score |\n"
+        "|------|:-----:|\n"
+        "| alice | 1 |\n"
+        "| bob | 2 |\n"
+        "Done."
+    )
+
+    elements = channel._build_card_elements(content)
+
+    assert [e["tag"] for e in elements] == ["markdown", "table", "markdown"]
+    assert elements[0]["content"] == "Results:"
+    table = elements[1]
+    assert [c["display_name"] for c in table["columns"]] == ["name", "score"]
+    assert table["rows"] == [{"c0": "alice", "c1": "1"}, {"c0": "bob", "c1": "2"}]
+    assert elements[2]["content"] == "Done."
+
+
+def test_build_card_elements_ignores_pipes_without_separator_row() -> None:
+    channel = _make_channel()
+    content = "| not | a table |\n| still | not |\n"
+
+    assert channel._build_card_elements(content) == [
+        {"tag": "markdown", "content": content.strip()}
+    ]
+
+
+def test_parse_md_table_pads_short_rows_and_drops_extra_cells() -> None:
+    table = FeishuChannel._parse_md_table(
+        "| a | b | c |\n|---|---|---|\n| 1 |\n| 1 | 2 | 3 | 4 |\n"
+    )
+
+    assert table is not None
+    assert table["page_size"] == 3
+    assert [c["name"] for c in table["columns"]] == ["c0", "c1", "c2"]
+    assert table["rows"] == [
+        {"c0": "1", "c1": "", "c2": ""},
+        {"c0": "1", "c1": "2", "c2": "3"},
+    ]
+
+
+def test_get_extension_prefers_mime_type_case_insensitively() -> None:
+    assert FeishuChannel._get_extension("file", "application/pdf") == ".pdf"
+    assert FeishuChannel._get_extension("image", "Image/PNG") == ".png"
+    assert FeishuChannel._get_extension("image", "image/x-unknown") == ".jpg"
+    assert FeishuChannel._get_extension("file") == ""
+
+
+def test_table_regex_does_not_span_lines_in_separator() -> None:
+    content = "| a | b |\n|\n|---|---|\n| 1 | 2 |\n"
+
+    assert FeishuChannel._TABLE_RE.search(content) is None
+
+
+
+def _make_event(
+    message_id: str,
+    sender_type: str = "bot",
+    message_type: str = "text",
+    content: str = "",
+) -> SimpleNamespace:
+    return SimpleNamespace(
+        event=SimpleNamespace(
+            message=SimpleNamespace(
+                message_id=message_id,
+                chat_id="oc_group",
+                chat_type="p2p",
+                message_type=message_type,
+                content=content,
+            ),
+            sender=SimpleNamespace(
+                sender_type=sender_type,
+                sender_id=SimpleNamespace(open_id="ou_alice"),
+            ),
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_on_message_dedup_cache_is_bounded() -> None:
+    channel = _make_channel()
+    maxlen = channel._processed_message_order.maxlen
+
+    for i in range(maxlen + 5):
+        await channel._on_message(_make_event(f"om_{i}"))
+
+    assert len(channel._processed_message_ids) == maxlen
+    assert "om_4" not in channel._processed_message_ids
+    assert "om_5" in channel._processed_message_ids
+    assert set(channel._processed_message_order) == channel._processed_message_ids
+
+
+@pytest.mark.asyncio
+async def test_on_message_forwards_text_to_bus() -> None:
+    channel = _make_channel()
+
+    await channel._on_message(
+        _make_event("om_1", sender_type="user", content='{"text": "hello"}')
+    )
+
+    msg = await channel.bus.consume_inbound()
+    assert msg.sender_id == "ou_alice"
+    assert msg.chat_id == "ou_alice"
+    assert msg.content == "hello"
+    assert msg.media == []
+    assert msg.metadata["msg_type"] == "text"
+
+
+@pytest.mark.asyncio
+async def test_on_message_media_placeholder_keeps_caption() -> None:
+    channel = _make_channel()
+
+    await channel._on_message(
+        _make_event(
+            "om_1",
+            sender_type="user",
+            message_type="sticker",
+            content='{"text": "look at this"}',
+        )
+    )
+
+    msg = await channel.bus.consume_inbound()
+    assert msg.content == "[sticker]\nlook at this"
+    assert msg.media == []
+
+
+class FakeResourceResponse:
+    def __init__(self, payload: bytes) -> None:
+        self.file = BytesIO(payload)
+
+    def success(self) -> bool:
+        return True
+
+
+class FailingReader:
+    """File object that yields one chunk and then fails, like a broken stream."""
+
+    def __init__(self) -> None:
+        self._chunks = [b"x" * 1024]
+
+    def read(self, _size: int = -1) -> bytes:
+        if self._chunks:
+            return self._chunks.pop()
+        raise OSError("stream broken")
+
+
+def _set_resource_getter(channel: FeishuChannel, fake_get) -> None:
+    channel._client = SimpleNamespace(
+        im=SimpleNamespace(v1=SimpleNamespace(message_resource=SimpleNamespace(get=fake_get)))
+    )
+
+
+@pytest.mark.asyncio
+async def test_download_file_writes_media_into_workspace(tmp_path) -> None:
+    channel = _make_channel(workspace=tmp_path)
+    channel._media_dir.mkdir()  # normally created by start()
+    requests = []
+
+    def fake_get(request):
+        requests.append(request)
+        return FakeResourceResponse(b"\x89PNG payload")
+
+    _set_resource_getter(channel, fake_get)
+
+    file_path = await channel._download_file("img_v3_0123456789abcdef", "image", "om_1")
+
+    assert file_path is not None
+    assert Path(file_path).parent == tmp_path / "media"
+    assert Path(file_path).suffix == ".jpg"
+    assert Path(file_path).read_bytes() == b"\x89PNG payload"
+    assert len(requests) == 1
+
+    # Same file_key again: reuse the file on disk instead of fetching it
+    assert await channel._download_file("img_v3_0123456789abcdef", "image", "om_2") == file_path
+    assert len(requests) == 1
+
+    # A key sharing the first 16 characters must not collide
+    other_path = await channel._download_file("img_v3_0123456789abcdXX", "image", "om_3")
+    assert other_path != file_path
+    assert len(requests) == 2
+
+
+
+@pytest.mark.asyncio
+async def test_concurrent_downloads_of_same_key_share_one_complete_file(tmp_path) -> None:
+    channel = _make_channel(workspace=tmp_path)
+    channel._media_dir.mkdir()
+    payload = b"x" * (4 * 1024 * 1024)
+    requests = []
+
+    def fake_get(request):
+        requests.append(request)
+        time.sleep(0.05)  # keep the first download in flight while the second arrives
+        return FakeResourceResponse(payload)
+
+    _set_resource_getter(channel, fake_get)
+
+    paths = await asyncio.gather(
+        channel._download_file("img_v3_shared", "image", "om_1"),
+        channel._download_file("img_v3_shared", "image", "om_2"),
+    )
+
+    assert paths[0] is not None and paths[0] == paths[1]
+    assert Path(paths[0]).read_bytes() == payload
+    assert len(requests) == 1
+    assert channel._pending_downloads == {}
+
+
+@pytest.mark.asyncio
+async def test_failed_write_is_not_reused(tmp_path) -> None:
+    channel = _make_channel(workspace=tmp_path)
+    channel._media_dir.mkdir()
+    responses = [SimpleNamespace(file=FailingReader(), success=lambda: True),
+                 FakeResourceResponse(b"complete")]
+    requests = []
+
+    def fake_get(request):
+        requests.append(request)
+        return responses.pop(0)
+
+    _set_resource_getter(channel, fake_get)
+
+    assert await channel._download_file("img_v3_flaky", "image", "om_1") is None
+    assert list(channel._media_dir.iterdir()) == []  # no partial or temp file left behind
+
+    file_path = await channel._download_file("img_v3_flaky", "image", "om_2")
+    assert file_path is not None
+    assert Path(file_path).read_bytes() == b"complete"
+    assert len(requests) == 2
+
+
+
+@pytest.mark.asyncio
+async def test_download_file_recreates_removed_media_dir(tmp_path) -> None:
+    channel = _make_channel(workspace=tmp_path)
+    assert not channel._media_dir.exists()  # e.g. deleted after start()
+    _set_resource_getter(channel, lambda request: FakeResourceResponse(b"payload"))
+
+    file_path = await channel._download_file("file_v3_gone", "file", "om_1")
+
+    assert file_path is not None
+    assert Path(file_path).read_bytes() == b"payload"
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_dumps_is_compact_and_keeps_unicode(monkeypatch, use_orjson) -> None:
+    if not use_orjson:
+        monkeypatch.setattr(feishu, "orjson", None)
+    elif feishu.orjson is None:
+        pytest.skip("orjson not installed")
+
+    card = {"elements": [{"tag": "markdown", "content": "你好"}]}
+
+    assert feishu._json_dumps(card) == '{"elements":[{"tag":"markdown","content":"你好"}]}'
+
+
+def test_write_file_sync_copies_non_bytesio_file_objects(tmp_path) -> None:
+    source = tmp_path / "source.bin"
+    source.write_bytes(b"x" * (3 * 1024 * 1024 + 7))
+    target = tmp_path / "target.bin"
+
+    with open(source, "rb") as f:
+        FeishuChannel._write_file_sync(target, f)
+
+    assert target.read_bytes() == source.read_bytes()